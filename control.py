@@ -17,16 +17,20 @@
 
 import argparse
 import asyncio
-import collections
 import contextlib
+import functools
+import itertools
 import json
 import math
+import operator
+import os
 import pygame
 import socket
+import struct
 import subprocess
+import tempfile
 import time
 import urwid
-import weakref
 
 IP = '192.168.99.1'
 RTSP_PORT = 554
@@ -35,12 +39,26 @@ FFPLAY_CMD = 'ffplay'
 EXTRA_FFPLAY_PARAM = ['-rtsp_transport', 'tcp', '-an']
 CONTROL_PORT = 9001
 UPDATE_INTERVAL = 0.05
+VIDEO_CHECK_INTERVAL = 0.5
 SETTINGS_PATH = '.control.json'
 DEFAULT_MAPPING_PATH = 'joystick.json'
 SAVE_SETTINGS = ['speed', 'throttle_trim', 'rudder_trim', 'elevator_trim',
                  'aileron_trim']
 DEFAULT_DEADZONE = 0.1
 TITLE = 'E32HW Control'
+# virtual buttons of a hat position as bit mask (left, down, right, up),
+# the bit index is the offset of the button
+HAT_MASKS = {
+    (-1, 1): 0b1001, (0, 1): 0b1000, (1, 1): 0b1100,
+    (-1, 0): 0b0001, (0, 0): 0b0000, (1, 0): 0b0100,
+    (-1, -1): 0b0011, (0, -1): 0b0010, (1, -1): 0b0110}
+NO_BUTTONS = frozenset()
+# axes, trimmers and flags in byte 14 to 24 of the control packet
+CONTROL_STRUCT = struct.Struct('11B')
+# hot-plugging of joysticks requires pygame 2
+JOY_DEVICE_EVENTS = tuple(
+    getattr(pygame, name) for name in ['JOYDEVICEADDED', 'JOYDEVICEREMOVED']
+    if hasattr(pygame, name))
 
 
 class RangedProperty(property):
@@ -49,17 +67,20 @@ class RangedProperty(property):
         self._min_value = min_value
         self._max_value = max_value
         self._default_value = value
-        self._values = {}
+
+    def __set_name__(self, owner, name):
+        # the value is stored in a slot of the instance
+        self._attr = '_{}'.format(name)
+
+    def init_instance(self, obj):
+        setattr(obj, self._attr, self._default_value)
 
     def _get(self, obj):
-        return self._values.get(id(obj), self._default_value)
+        return getattr(obj, self._attr)
 
     def _set(self, obj, value):
         value = min(max(value, self._min_value), self._max_value)
-        key = id(obj)
-        if key not in self._values:
-            weakref.finalize(obj, self._values.pop, key)
-        self._values[key] = value
+        setattr(obj, self._attr, value)
 
 
 class TimedProperty(property):
@@ -67,28 +88,29 @@ class TimedProperty(property):
         super().__init__(self._get, self._set)
         self._default_value = default_value
         self._timeout = timeout
-        self._values = {}
 
-    def _get(self, obj):
-        start_time, value = self._values.get(id(obj), (0, self._default_value))
-        if time.perf_counter() - start_time < self._timeout:
+    def __set_name__(self, owner, name):
+        # the start time and value are stored in a slot of the instance
+        self._attr = '_{}'.format(name)
+
+    def init_instance(self, obj):
+        setattr(obj, self._attr, (0, self._default_value))
+
+    def _get(self, obj, _perf_counter=time.perf_counter):
+        start_time, value = getattr(obj, self._attr)
+        if _perf_counter() - start_time < self._timeout:
             return value
         return self._default_value
 
-    def _set(self, obj, value):
-        key = id(obj)
-        if key not in self._values:
-            weakref.finalize(obj, self._values.pop, key)
-        self._values[key] = (time.perf_counter(), value)
+    def _set(self, obj, value, _perf_counter=time.perf_counter):
+        setattr(obj, self._attr, (_perf_counter(), value))
 
 
-def bits_to_byte(*bits):
-    assert len(bits) <= 8
-    value = 0
-    for i, b in enumerate(bits):
-        if b:
-            value |= 1 << i
-    return value
+def hat_buttons(hat, mask):
+    while mask:
+        bit = mask & -mask
+        yield ('hat', hat * 4 + bit.bit_length() - 1)
+        mask ^= bit
 
 
 class Vehicle:
@@ -167,20 +189,20 @@ class Vehicle:
     elevator = RangedProperty(-1, 1, 0)
     elevator_trim = RangedProperty(-1, 1, 0)
 
-    hight = False
-    _fly_no_head = False
-    speed = False
     fly_360_roll = TimedProperty(0.5, False)
     engine_start = TimedProperty(1, False)
     fly_down = TimedProperty(1, False)
     fly_up = TimedProperty(1, False)
-    _fly_back = False
-    _stop = False
-    middle_speed = False
-    _up = False
-    control_type = False
     product_type = RangedProperty(1, 3, 1)
-    light = True
+
+    __slots__ = (
+        '_throttle', '_throttle_trim', '_rudder', '_rudder_trim',
+        '_aileron', '_aileron_trim', '_elevator', '_elevator_trim',
+        'hight', '_fly_no_head', 'speed', '_fly_360_roll', '_engine_start',
+        '_fly_down', '_fly_up', '_fly_back', '_stop', 'middle_speed', '_up',
+        'control_type', '_product_type', 'light',
+        '_saved_settings', '_sock', '_addr', '_send', '_packet',
+        '_prev_counter', '_prev_sum')
 
     @property
     def fly_no_head(self):
@@ -220,12 +242,63 @@ class Vehicle:
         self._up = value
 
     def __init__(self):
+        # fill the slots of all descriptors, reading an empty slot is slow
+        for prop in vars(Vehicle).values():
+            if isinstance(prop, (RangedProperty, TimedProperty)):
+                prop.init_instance(self)
+        self.hight = False
+        self._fly_no_head = False
+        self.speed = False
+        self._fly_back = False
+        self._stop = False
+        self.middle_speed = False
+        self._up = False
+        self.control_type = False
+        self.light = True
+
         self._sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        self._prev_packet = [0] * 26
+        # don't block the event loop on a full send queue, the next update
+        # sends newer values anyway
+        self._sock.setblocking(False)
+        # mark as expedited forwarding (DSCP 46), mapped to the voice
+        # access category by WMM
+        with contextlib.suppress(OSError):
+            self._sock.setsockopt(socket.IPPROTO_IP, socket.IP_TOS, 0xb8)
+        if hasattr(socket, 'SO_PRIORITY'):
+            with contextlib.suppress(OSError):
+                self._sock.setsockopt(socket.SOL_SOCKET, socket.SO_PRIORITY,
+                                      6)
+        # the socket is not connected, a connected socket keeps the source
+        # address of the network it was connected in (e.g. before joining
+        # the WLAN of the quad-copter)
+        self._addr = (IP, CONTROL_PORT)
+        self._send = self._sock.sendto
+        self._packet = bytearray([
+            0x5b,
+            0x52,
+            0x74,
+            0x3e,
+            0x1a,
+            0x00,
+            0x01,
+            0x00,  # counter
+            0xe0,
+            0x00,
+            0x00,  # diff
+            0x00,
+            0xff,
+            0x02,
+            *bytes(12)])
+        # counter and byte sum of the previously sent packet
+        self._prev_counter = 0
+        self._prev_sum = 0
 
+        # settings as stored in the file, to skip writing unchanged settings
+        self._saved_settings = None
         with contextlib.suppress(FileNotFoundError):
             with open(SETTINGS_PATH) as f:
                 j = json.load(f)
+            self._saved_settings = j
             for k in SAVE_SETTINGS:
                 if k in j:
                     setattr(self, k, j[k])
@@ -234,67 +307,91 @@ class Vehicle:
         return 'rtsp://{}:{}{}'.format(IP, RTSP_PORT, RTSP_PATH)
 
     def cleanup(self):
-        with open(SETTINGS_PATH, 'w') as f:
-            json.dump({k: getattr(self, k) for k in SAVE_SETTINGS}, f,
-                      indent=4, sort_keys=True)
-
-    def update(self):
-        cmd = [
-            0xff,
-            0x02,
-            min(math.floor(self.throttle * 64) + 64, 127),
-            min(math.floor(self.rudder * 64) + 64, 127),
-            min(math.floor(self.elevator * 64) + 64, 127),
-            min(math.floor(self.aileron * 64) + 64, 127),
-            min(math.floor(self.throttle_trim * 32) + 32, 63),
-            min(math.floor(self.aileron_trim * 32) + 32, 63),
-            min(math.floor(self.elevator_trim * 32) + 32, 63),
-            min(math.floor(self.rudder_trim * 32) + 32, 63),
-            bits_to_byte(
-                self.hight,
-                self.fly_no_head,
-                self.speed,
-                self.fly_360_roll,
-                self.engine_start,
-                self.fly_down,
-                self.fly_up),
-            bits_to_byte(
-                self.fly_back,
-                self.stop,
-                self.middle_speed,
-                self.up,
-                self.control_type,
-                self.product_type & 1,
-                self.product_type & 2),
-            bits_to_byte(
-                self.light)]
+        settings = {k: getattr(self, k) for k in SAVE_SETTINGS}
+        if settings == self._saved_settings:
+            return
+        data = json.dumps(settings, indent=4, sort_keys=True)
+        # replace the file atomically, an interrupted write must not leave
+        # truncated settings behind
+        fd, tmp_path = tempfile.mkstemp(
+            prefix='{}.'.format(os.path.basename(SETTINGS_PATH)),
+            suffix='.tmp',
+            dir=os.path.dirname(os.path.abspath(SETTINGS_PATH)))
+        try:
+            # mkstemp uses mode 0600, keep the permissions that open()
+            # would give the settings file
+            try:
+                mode = os.stat(SETTINGS_PATH).st_mode & 0o7777
+            except FileNotFoundError:
+                umask = os.umask(0)
+                os.umask(umask)
+                mode = 0o666 & ~umask
+            os.chmod(fd, mode)
+            with open(fd, 'w') as f:
+                f.write(data)
+            os.replace(tmp_path, SETTINGS_PATH)
+        except BaseException:
+            with contextlib.suppress(OSError):
+                os.remove(tmp_path)
+            raise
+
+    # builtins are bound as default arguments for fast local lookup
+    def update(self, _int=int, _sum=sum):
+        packet = self._packet
+        packet[7] = (self._prev_counter + 1) & 0xff
+        packet[10] = 0x00  # placeholder
+        # axes are clamped to [-1, 1], so the argument of int() is never
+        # negative and truncation rounds down like math.floor
+        throttle = _int(self.throttle * 64 + 64)
+        rudder = _int(self.rudder * 64 + 64)
+        elevator = _int(self.elevator * 64 + 64)
+        aileron = _int(self.aileron * 64 + 64)
+        throttle_trim = _int(self.throttle_trim * 32 + 32)
+        aileron_trim = _int(self.aileron_trim * 32 + 32)
+        elevator_trim = _int(self.elevator_trim * 32 + 32)
+        rudder_trim = _int(self.rudder_trim * 32 + 32)
+        CONTROL_STRUCT.pack_into(
+            packet, 14,
+            throttle if throttle < 127 else 127,
+            rudder if rudder < 127 else 127,
+            elevator if elevator < 127 else 127,
+            aileron if aileron < 127 else 127,
+            throttle_trim if throttle_trim < 63 else 63,
+            aileron_trim if aileron_trim < 63 else 63,
+            elevator_trim if elevator_trim < 63 else 63,
+            rudder_trim if rudder_trim < 63 else 63,
+            # flag bytes, the flags are booleans and act as 0 or 1
+            (self.hight |
+             self.fly_no_head << 1 |
+             self.speed << 2 |
+             self.fly_360_roll << 3 |
+             self.engine_start << 4 |
+             self.fly_down << 5 |
+             self.fly_up << 6),
+            (self.fly_back |
+             self.stop << 1 |
+             self.middle_speed << 2 |
+             self.up << 3 |
+             self.control_type << 4 |
+             (self.product_type & 0x3) << 5),
+            self.light)
         # checksum
-        cmd.append(sum(cmd[1:]) & 0x7f)
-        packet = [
-            0x5b,
-            0x52,
-            0x74,
-            0x3e,
-            0x1a,
-            0x00,
-            0x01,
-            (self._prev_packet[7] + 1) & 0xff,
-            0xe0,
-            0x00,
-            0x00,  # placeholder
-            0x00,
-            *cmd]
-
-        diff = 0
-        for a, b in zip(self._prev_packet, packet):
-            diff += a - b
-        packet[10] = diff % 0xff
+        packet[25] = _sum(memoryview(packet)[13:25]) & 0x7f
+
+        # sum of byte-wise differences equals the difference of the sums,
+        # the sum of the previous packet is remembered
+        packet_sum = _sum(packet)
+        # the protocol takes the sum modulo 0xff, not 0x100 (see ReadMe)
+        diff = (self._prev_sum - packet_sum) % 0xff
+        packet[10] = diff
         try:
-            self._sock.sendto(bytes(packet), (IP, CONTROL_PORT))
+            self._send(packet, self._addr)
         except OSError:
+            # e.g. the WLAN is not available, retry on the next update
             pass
         else:
-            self._prev_packet = packet
+            self._prev_counter = packet[7]
+            self._prev_sum = packet_sum + diff
 
 
 class Ui:
@@ -317,16 +414,17 @@ class Ui:
         axis_labels = []
         axis_values = []
         self._bars = {}
+        self._completions = {}
         for e in vehicle.inputs:
             if e['type'] != 'axis':
                 continue
-            axis_labels.append(urwid.Text('{}:'.format(e['desc'])))
+            axis_labels.append('{}:'.format(e['desc']))
             bar = urwid.ProgressBar(
                 'progress_normal', 'progress_complete', 50)
             axis_values.append(bar)
             self._bars[e['id']] = bar
             if e.get('trim'):
-                axis_labels.append(urwid.Text('{} Trim:'.format(e['desc'])))
+                axis_labels.append('{} Trim:'.format(e['desc']))
                 bar_trim = urwid.ProgressBar(
                     'progress_normal', 'progress_complete', 50)
                 trim_step = e['trim_step']
@@ -338,10 +436,11 @@ class Ui:
                     ('weight', 0, inc)], min_width=5))
                 self._bars['{}_trim'.format(e['id'])] = bar_trim
 
-        labels = urwid.Pile(axis_labels)
+        labels = urwid.Pile([urwid.Text(label) for label in axis_labels])
         values = urwid.Pile(axis_values)
 
-        labels_minwidth = max(w[0].pack()[0] for w in labels.contents)
+        # the labels are single lines, no need to let urwid lay them out
+        labels_minwidth = max(len(label) for label in axis_labels)
         cols = urwid.Columns(
             [(labels_minwidth, labels), values], dividechars=1)
 
@@ -362,6 +461,12 @@ class Ui:
             checkboxes.append(ch)
             self._checkboxes[e['id']] = ch
 
+        # resolve the vehicle attributes once, instead of on each update
+        self._checkbox_getters = [(operator.attrgetter(k), v)
+                                  for k, v in self._checkboxes.items()]
+        self._bar_getters = [(k, operator.attrgetter(k), v)
+                             for k, v in self._bars.items()]
+
         def exit(obj):
             raise urwid.ExitMainLoop()
         exit_btn = urwid.Button('Exit', on_press=exit)
@@ -375,10 +480,16 @@ class Ui:
         pass
 
     def update(self):
-        for k, v in self._checkboxes.items():
-            v.set_state(getattr(self._vehicle, k))
-        for k, v in self._bars.items():
-            v.set_completion(round((getattr(self._vehicle, k) + 1) * 50))
+        vehicle = self._vehicle
+        # CheckBox.set_state already ignores unchanged states
+        for getter, checkbox in self._checkbox_getters:
+            checkbox.set_state(getter(vehicle))
+        # ProgressBar.set_completion always causes a redraw
+        for k, getter, bar in self._bar_getters:
+            completion = round((getter(vehicle) + 1) * 50)
+            if self._completions.get(k) != completion:
+                bar.set_completion(completion)
+                self._completions[k] = completion
 
     def loop(self):
         self._loop.run()
@@ -416,6 +527,7 @@ class MappingUi:
         self._locked_axes = set()
         self._current = 0
         self._current_sub = 0  # for trimmer
+        self._done_text = ''
         self._update_text()
 
     def _pretty_input(self, input_mapping):
@@ -435,41 +547,47 @@ class MappingUi:
                     self._current_sub < 2):
                 self._current_sub += 1
             else:
+                # the text of finished inputs doesn't change anymore
+                self._done_text += self._input_text(_input, math.inf)
                 self._current += 1
                 self._current_sub = 0
         self._update_text()
 
+    def _input_text(self, _input, sub):
+        # sub is the current step of the input (infinite if finished)
+        parts = []
+        if _input['type'] == 'axis':
+            parts.append('Choose a joystick axis for {} [left or down]'.format(
+                _input['desc']))
+        else:
+            parts.append('Choose a joystick button for {}'.format(
+                _input['desc']))
+        if sub > 0:
+            input_name = '{}_{}'.format(
+                _input['id'], 'axis' if _input['type'] == 'axis' else 'btn')
+            parts.append(' ==> {}\n'.format(self._pretty_input(
+                self.mapping.get(input_name))))
+        if _input.get('trim'):
+            for trim_sub, sub_name, pretty_name in [(1, 'dec', 'Decrease'),
+                                                    (2, 'inc', 'Increase')]:
+                if sub >= trim_sub:
+                    parts.append(('Choose a joystick button for {} Trimmer '
+                                  '{}').format(_input['desc'], pretty_name))
+                if sub > trim_sub:
+                    input_name = '{}_trim_{}_btn'.format(
+                        _input['id'], sub_name)
+                    parts.append(' ==> {}\n'.format(self._pretty_input(
+                        self.mapping.get(input_name))))
+        return ''.join(parts)
+
     def _update_text(self):
         if self._current >= len(self._vehicle.inputs):
             self._btn.set_label('Finish')
+            text = self._done_text
         else:
             self._btn.set_label('Skip')
-        text = ''
-        for i, _input in enumerate(self._vehicle.inputs[:self._current + 1]):
-            if _input['type'] == 'axis':
-                text += 'Choose a joystick axis for {} [left or down]'.format(
-                    _input['desc'])
-            else:
-                text += 'Choose a joystick button for {}'.format(
-                    _input['desc'])
-            if i < self._current or self._current_sub > 0:
-                input_name = '{}_{}'.format(
-                    _input['id'],
-                    'axis' if _input['type'] == 'axis' else 'btn')
-                text += ' ==> {}\n'.format(self._pretty_input(
-                    self.mapping.get(input_name)))
-            if not _input.get('trim'):
-                continue
-            for sub, sub_name, pretty_name in [(1, 'dec', 'Decrease'),
-                                               (2, 'inc', 'Increase')]:
-                if i < self._current or self._current_sub >= sub:
-                    text += ('Choose a joystick button for {} Trimmer '
-                             '{}').format(_input['desc'], pretty_name)
-                if i < self._current or self._current_sub > sub:
-                    input_name = '{}_trim_{}_btn'.format(
-                        _input['id'], input_name)
-                    text += ' ==> {}\n'.format(self._pretty_input(
-                        self.mapping.get(input_name)))
+            text = self._done_text + self._input_text(
+                self._vehicle.inputs[self._current], self._current_sub)
         text = text.rstrip('\n')
         self._text.set_text(text + '\n')
 
@@ -481,10 +599,18 @@ class MappingUi:
             return
         buttons_down, _, _, axes = self._joystick.get_state()
         buttons_down = sorted(buttons_down)
+        _input = self._vehicle.inputs[self._current]
+        choose_axis = _input['type'] == 'axis' and self._current_sub == 0
+        # release axes back at the center and find the first unlocked axis
+        # that is fully deflected in a single pass
+        chosen_axis = None
         for i, axis in enumerate(axes):
-            if abs(axis) < 0.1:
+            abs_axis = abs(axis)
+            if abs_axis < 0.1:
                 self._locked_axes.discard(i)
-        _input = self._vehicle.inputs[self._current]
+            elif (choose_axis and chosen_axis is None and abs_axis >= 0.9 and
+                    i not in self._locked_axes):
+                chosen_axis = i, axis
         if _input['type'] == 'axis' and self._current_sub > 0:
             sub_name = 'dec' if self._current_sub == 1 else 'inc'
             input_name = '{}_trim_{}_btn'.format(_input['id'], sub_name)
@@ -492,13 +618,12 @@ class MappingUi:
                 self.mapping[input_name] = buttons_down[0]
                 self._next_input()
         elif _input['type'] == 'axis':
-            for i, axis in enumerate(axes):
-                if abs(axis) >= 0.9 and i not in self._locked_axes:
-                    self._locked_axes.add(i)
-                    input_name = '{}_axis'.format(_input['id'])
-                    self.mapping[input_name] = (i, axis >= 0)
-                    self._next_input()
-                    break
+            if chosen_axis:
+                i, axis = chosen_axis
+                self._locked_axes.add(i)
+                input_name = '{}_axis'.format(_input['id'])
+                self.mapping[input_name] = (i, axis >= 0)
+                self._next_input()
         elif buttons_down:
             self.mapping['{}_btn'.format(_input['id'])] = buttons_down[0]
             self._next_input()
@@ -513,18 +638,21 @@ class Joystick:
         pygame.joystick.init()
         self._vehicle = vehicle
         self._prev_hats = {}
+        self._joystick = None
+        self._num_hats = self._num_buttons = self._num_axes = 0
+        self._open_joystick()
 
         self._map = {}
         for k, v in joystick_mapping.items():
             if k.endswith('_axis'):
-                if isinstance(v, collections.Iterable):
+                if isinstance(v, (list, tuple)):
                     v = tuple(v)
                 else:
                     v = (v, False)
                 if v[0] is None or v[0] < 0:
                     continue
             elif k.endswith('_btn'):
-                if isinstance(v, collections.Iterable):
+                if isinstance(v, (list, tuple)):
                     v = tuple(v)
                 else:
                     v = ('btn', v)
@@ -535,126 +663,162 @@ class Joystick:
                     continue
             self._map[k] = v
         self._map['DEADZONE'] = self._map.get('DEADZONE', DEFAULT_DEADZONE)
+        self._deadzone = self._map['DEADZONE']
+        self._deadzone_scale = (1 / (1 - self._deadzone)
+                                if self._deadzone < 1 else 0)
+
+        # resolve the mapping of every input once, instead of on each update
+        self._axis_plan = []
+        # pressed button -> [(order, action)], actions run in input order
+        self._press_actions = {}
+        self._push_plan = []
+        order = itertools.count()
+
+        def add_press_action(button, action):
+            if button is not None:
+                self._press_actions.setdefault(button, []).append(
+                    (next(order), action))
+
+        for e in vehicle.inputs:
+            if e['type'] == 'axis':
+                axis, invert = self._map.get('{}_axis'.format(e['id']),
+                                             (None, None))
+                if axis is None:
+                    continue
+                self._axis_plan.append((
+                    axis, invert,
+                    functools.partial(setattr, vehicle, e['id'])))
+                if e.get('trim'):
+                    trim_id = '{}_trim'.format(e['id'])
+                    add_press_action(
+                        self._map.get('{}_trim_dec_btn'.format(e['id'])),
+                        functools.partial(self._adjust_trim, axis, trim_id,
+                                          -e['trim_step']))
+                    add_press_action(
+                        self._map.get('{}_trim_inc_btn'.format(e['id'])),
+                        functools.partial(self._adjust_trim, axis, trim_id,
+                                          e['trim_step']))
+            else:
+                button = self._map.get('{}_btn'.format(e['id']))
+                if button is None:
+                    continue
+                if e['type'] == 'push':
+                    self._push_plan.append((
+                        button, functools.partial(setattr, vehicle, e['id'])))
+                elif e['type'] == 'once':
+                    add_press_action(button, functools.partial(
+                        setattr, vehicle, e['id'], True))
+                else:
+                    add_press_action(button, functools.partial(
+                        self._toggle, e['id']))
 
     def cleanup(self):
         pass
 
+    def _toggle(self, _id):
+        setattr(self._vehicle, _id, not getattr(self._vehicle, _id))
+
+    def _adjust(self, _id, step):
+        setattr(self._vehicle, _id, getattr(self._vehicle, _id) + step)
+
+    def _adjust_trim(self, axis, _id, step):
+        # trimmers only work if the trimmed axis exists on the joystick
+        if axis < self._num_axes:
+            self._adjust(_id, step)
+
+    def _open_joystick(self):
+        if pygame.joystick.get_count() == 0:
+            self._joystick = None
+            self._num_hats = self._num_buttons = self._num_axes = 0
+            return
+        self._joystick = pygame.joystick.Joystick(0)
+        self._joystick.init()
+        self._num_hats = self._joystick.get_numhats()
+        self._num_buttons = self._joystick.get_numbuttons()
+        self._num_axes = self._joystick.get_numaxes()
+
     def _normalize_axis(self, value):
-        value = min(max(value, -1.0), 1.0)
-        abs_value = abs(value)
-        if abs_value < self._map['DEADZONE']:
-            norm_value = 0
-        else:
-            norm_value = abs_value - self._map['DEADZONE']
-            norm_value /= 1 - self._map['DEADZONE']
-            norm_value = min(1.0, norm_value)
-            if value <= 0:
-                norm_value *= -1
-        return norm_value
+        norm_value = max(0.0, abs(value) - self._deadzone)
+        norm_value *= self._deadzone_scale
+        return math.copysign(min(norm_value, 1.0), value)
 
     def get_state(self):
-        buttons_down = set()
-        buttons_up = set()
+        # drain the whole queue in one pass, other events are dropped
+        events = pygame.event.get()
+        if events:
+            buttons_down = set()
+            buttons_up = set()
+        else:
+            # common case while flying, the empty sets are shared
+            buttons_down = buttons_up = NO_BUTTONS
         active_buttons = set()
-        axes = []
-
-        button_events = pygame.event.get([
-            pygame.JOYBUTTONDOWN, pygame.JOYBUTTONUP, pygame.JOYHATMOTION])
-        pygame.event.clear()
-        if pygame.joystick.get_count() == 0:
-            return buttons_down, buttons_up, active_buttons, axes
-        joystick = pygame.joystick.Joystick(0)
-        joystick.init()
 
-        for e in button_events:
-            if e.type == pygame.JOYBUTTONDOWN:
+        reopen_joystick = False
+        for e in events:
+            event_type = e.type
+            if event_type == pygame.JOYBUTTONDOWN:
                 buttons_down.add(('btn', e.button))
-            elif e.type == pygame.JOYBUTTONUP:
+            elif event_type == pygame.JOYBUTTONUP:
                 buttons_up.add(('btn', e.button))
-            elif e.type == pygame.JOYHATMOTION:
-                prev_hat = self._prev_hats.get(e.hat, (0, 0))
-                self._prev_hats[e.hat] = e.value
-                if prev_hat[0] == -1 and e.value[0] != -1:
-                    buttons_up.add(('hat', e.hat * 4 + 0))
-                if prev_hat[0] != -1 and e.value[0] == -1:
-                    buttons_down.add(('hat', e.hat * 4 + 0))
-                if prev_hat[0] == 1 and e.value[0] != 1:
-                    buttons_up.add(('hat', e.hat * 4 + 2))
-                if prev_hat[0] != 1 and e.value[0] == 1:
-                    buttons_down.add(('hat', e.hat * 4 + 2))
-                if prev_hat[1] == 1 and e.value[1] != 1:
-                    buttons_up.add(('hat', e.hat * 4 + 3))
-                if prev_hat[1] != 1 and e.value[1] == 1:
-                    buttons_down.add(('hat', e.hat * 4 + 3))
-                if prev_hat[1] == -1 and e.value[1] != -1:
-                    buttons_up.add(('hat', e.hat * 4 + 1))
-                if prev_hat[1] != -1 and e.value[1] == -1:
-                    buttons_down.add(('hat', e.hat * 4 + 1))
-        for i in range(joystick.get_numhats()):
-            hat = joystick.get_hat(i)
-            if hat[0] == -1:
-                active_buttons.add(('hat', i * 4 + 0))
-            if hat[0] == 1:
-                active_buttons.add(('hat', i * 4 + 2))
-            if hat[1] == 1:
-                active_buttons.add(('hat', i * 4 + 3))
-            if hat[1] == -1:
-                active_buttons.add(('hat', i * 4 + 1))
-        for i in range(joystick.get_numbuttons()):
-            if joystick.get_button(i):
-                active_buttons.add(('btn', i))
-        for i in range(joystick.get_numaxes()):
-            raw_value = joystick.get_axis(i)
-            axes.append(self._normalize_axis(raw_value))
+            elif event_type == pygame.JOYHATMOTION:
+                prev_mask = self._prev_hats.get(e.hat, 0)
+                mask = HAT_MASKS[e.value]
+                self._prev_hats[e.hat] = mask
+                buttons_up.update(hat_buttons(e.hat, prev_mask & ~mask))
+                buttons_down.update(hat_buttons(e.hat, mask & ~prev_mask))
+            elif event_type in JOY_DEVICE_EVENTS:
+                reopen_joystick = True
+        if reopen_joystick:
+            self._open_joystick()
+        joystick = self._joystick
+        if joystick is None:
+            return buttons_down, buttons_up, active_buttons, []
+
+        # bind the polling methods once, they are called for every control
+        get_hat = joystick.get_hat
+        get_button = joystick.get_button
+        get_axis = joystick.get_axis
+        normalize_axis = self._normalize_axis
+        for i in range(self._num_hats):
+            active_buttons.update(hat_buttons(i, HAT_MASKS[get_hat(i)]))
+        active_buttons.update(('btn', i) for i in range(self._num_buttons)
+                              if get_button(i))
+        axes = [normalize_axis(get_axis(i)) for i in range(self._num_axes)]
         return buttons_down, buttons_up, active_buttons, axes
 
     def update(self):
         buttons_down, buttons_up, active_buttons, axes = self.get_state()
-        for e in self._vehicle.inputs:
-            if e['type'] == 'axis':
-                axis, invert = self._map.get('{}_axis'.format(e['id']),
-                                             (None, None))
-                if axis is None or axis >= len(axes):
-                    continue
-                value = axes[axis]
-                if invert:
-                    value *= -1
-                setattr(self._vehicle, e['id'], value)
-                if e.get('trim'):
-                    button_dec = self._map.get(
-                        '{}_trim_dec_btn'.format(e['id']))
-                    button_inc = self._map.get(
-                        '{}_trim_inc_btn'.format(e['id']))
-                    trim_id = '{}_trim'.format(e['id'])
-                    trim_step = e['trim_step']
-                    if button_dec in buttons_down:
-                        setattr(self._vehicle, trim_id,
-                                getattr(self._vehicle, trim_id) - trim_step)
-                    if button_inc in buttons_down:
-                        setattr(self._vehicle, trim_id,
-                                getattr(self._vehicle, trim_id) + trim_step)
-            else:
-                button = self._map.get('{}_btn'.format(e['id']))
-                if e['type'] == 'once':
-                    if button in buttons_down:
-                        setattr(self._vehicle, e['id'], True)
-                elif e['type'] == 'toggle':
-                    if button in buttons_down:
-                        setattr(self._vehicle, e['id'],
-                                not getattr(self._vehicle, e['id']))
-                elif e['type'] == 'push':
-                    if button in active_buttons:
-                        setattr(self._vehicle, e['id'], True)
-                    elif button in buttons_up:
-                        setattr(self._vehicle, e['id'], False)
+        for axis, invert, set_value in self._axis_plan:
+            if axis < len(axes):
+                set_value(-axes[axis] if invert else axes[axis])
+        if buttons_down:
+            # run the actions in the order of the inputs (e.g. headless mode
+            # resets return home)
+            for _, action in sorted(
+                    a for b in buttons_down
+                    for a in self._press_actions.get(b, ())):
+                action()
+        for button, set_value in self._push_plan:
+            if button in active_buttons:
+                set_value(True)
+            elif button in buttons_up:
+                set_value(False)
 
 
 class Video:
     def __init__(self, vehicle):
         self._process = None
         self._url = vehicle.start_video()
+        # the media player rarely exits, don't poll it on every update
+        self._check_ticks = max(1, round(VIDEO_CHECK_INTERVAL /
+                                         UPDATE_INTERVAL))
+        self._ticks_until_check = 0
 
     def update(self):
+        if self._ticks_until_check > 0:
+            self._ticks_until_check -= 1
+            return
+        self._ticks_until_check = self._check_ticks - 1
         if not self._process or self._process.poll() is not None:
             self._process = subprocess.Popen(
                 [FFPLAY_CMD, self._url, *EXTRA_FFPLAY_PARAM],
@@ -668,11 +832,24 @@ class Video:
 
 def run_services(run_loop_fn, services):
     done = False
+    updaters = tuple(s.update for s in services)
+    cleaners = tuple(s.cleanup for s in services)
 
     async def update():
+        loop = asyncio.get_event_loop()
+        # sleep until absolute deadlines, so the time spent in the updates
+        # doesn't slow down the update rate
+        deadline = loop.time()
         while not done:
-            [s.update() for s in services]
-            await asyncio.sleep(UPDATE_INTERVAL)
+            for update_service in updaters:
+                update_service()
+            deadline += UPDATE_INTERVAL
+            delay = deadline - loop.time()
+            if delay < 0:
+                # fallen behind (e.g. stalled), don't send a burst of updates
+                deadline = loop.time()
+                delay = 0
+            await asyncio.sleep(delay)
     asyncio.ensure_future(update())
     try:
         run_loop_fn()
@@ -680,7 +857,8 @@ def run_services(run_loop_fn, services):
         return False
     finally:
         done = True
-        [s.cleanup() for s in services]
+        for cleanup_service in cleaners:
+            cleanup_service()
     return True
 
 